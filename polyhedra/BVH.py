@@ -0,0 +1,272 @@
+import numpy as np
+from .tools import *
+
+class BVH:
+
+    ## A fixed, skew direction for casting the rays that count windings, chosen so that
+    ## rays are unlikely to pass exactly through an edge or vertex
+    winding_direction = np.asarray([0.5433960104, 0.6165839127, 0.5697713212])
+
+    ## The most (query, node) pairs walked down the tree together
+    max_pairs = 1 << 16
+
+    ## Build a bounding volume hierarchy over the faces of a Solid, cutting faces other than
+    ## triangles into fans about their centers as Face.build does. The BVH does not follow
+    ## later changes to the Solid.
+    def __init__(self, solid, leaf_size=8):
+
+        vertices = np.asarray(solid.vertices, dtype=float).reshape(-1, 3)
+        tri_ids = [f.vertex_ids for f in solid.faces if f.num_sides == 3]
+        tri_faces = [index for index, f in enumerate(solid.faces) if f.num_sides == 3]
+        triangles = [vertices[tri_ids].reshape(-1, 3, 3)]
+        face_ids = [np.asarray(tri_faces, dtype=np.int64)]
+
+        ## Other faces are fanned out from their centers
+        for index, f in enumerate(solid.faces):
+            if f.num_sides != 3:
+                ids = f.vertex_ids
+                coords = vertices[ids]
+                fan = np.empty((f.num_sides, 3, 3))
+                fan[:, 0] = coords.mean(axis=0)
+                fan[:, 1] = coords
+                fan[:, 2] = np.roll(coords, -1, axis=0)
+                triangles.append(fan)
+                face_ids.append(np.full(f.num_sides, index))
+
+        triangles = np.concatenate(triangles)
+        face_ids = np.concatenate(face_ids)
+
+        ## Split every node of a level at once, at the median of its triangles' centroids
+        ## along the longest side of their bounding box
+        centroids = triangles.mean(axis=1)
+        order = np.arange(len(triangles))
+        start = np.asarray([0])
+        stop = np.asarray([len(triangles)])
+        left = np.asarray([-1])
+        right = np.asarray([-1])
+        levels = [np.asarray([0])]
+        while True:
+            level = levels[-1]
+            split = level[stop[level] - start[level] > leaf_size]
+            if len(split) == 0: break
+
+            counts = stop[split] - start[split]
+            firsts = np.cumsum(counts) - counts
+            positions = np.repeat(start[split], counts) + np.arange(counts.sum()) - np.repeat(firsts, counts)
+            segment_centroids = centroids[order[positions]]
+            extents = np.maximum.reduceat(segment_centroids, firsts) - np.minimum.reduceat(segment_centroids, firsts)
+            axes = np.repeat(np.argmax(extents, axis=1), counts)
+            keys = segment_centroids[np.arange(len(positions)), axes]
+            order[positions] = order[positions][np.lexsort((keys, np.repeat(split, counts)))]
+
+            mid = start[split] + counts // 2
+            first = len(start) + 2 * np.arange(len(split))
+            start = np.concatenate([start, np.column_stack([start[split], mid]).reshape(-1)])
+            stop = np.concatenate([stop, np.column_stack([mid, stop[split]]).reshape(-1)])
+            left = np.concatenate([left, np.full(2 * len(split), -1)])
+            right = np.concatenate([right, np.full(2 * len(split), -1)])
+            left[split] = first
+            right[split] = first + 1
+            levels.append(np.arange(first[0], first[0] + 2 * len(split)))
+
+        triangles = triangles[order]
+        face_ids = face_ids[order]
+
+        ## Bound the leaves directly, then each level of internal nodes from the bottom up
+        lo = np.full((len(start), 3), np.inf)
+        hi = np.full((len(start), 3), -np.inf)
+        leaves = np.flatnonzero(left < 0)
+        leaves = leaves[np.argsort(start[leaves])]
+        if len(triangles) > 0:
+            lo[leaves] = np.minimum.reduceat(triangles.min(axis=1), start[leaves])
+            hi[leaves] = np.maximum.reduceat(triangles.max(axis=1), start[leaves])
+        for level in reversed(levels):
+            inner = level[left[level] >= 0]
+            lo[inner] = np.minimum(lo[left[inner]], lo[right[inner]])
+            hi[inner] = np.maximum(hi[left[inner]], hi[right[inner]])
+
+        self.solid = solid
+        self.leaf_size = leaf_size
+        self.triangles = triangles
+        self.face_ids = face_ids
+        a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+        self.normals = np.cross(b - a, c - a)
+        self.lo = lo
+        self.hi = hi
+        self.left = left
+        self.right = right
+        self.start = start
+        self.stop = stop
+
+    ## Find the parameters at which rays enter and leave the boxes of given nodes
+    def box_hits(self, nodes, origins, inv_directions):
+
+        t1 = (self.lo[nodes] - origins) * inv_directions
+        t2 = (self.hi[nodes] - origins) * inv_directions
+        t_near = np.minimum(t1, t2).max(axis=1)
+        t_far = np.maximum(t1, t2).min(axis=1)
+        return t_near, t_far
+
+    ## Find the squared distances from points to the boxes of given nodes
+    def box_distances(self, nodes, pts):
+
+        gap = np.maximum(self.lo[nodes] - pts, 0) + np.maximum(pts - self.hi[nodes], 0)
+        return np.sum(gap**2, axis=1)
+
+    ## Compute each ray's reciprocal direction, with zero components made tiny instead
+    def inverse_directions(directions):
+
+        with np.errstate(divide='ignore', over='ignore'):
+            return 1.0 / np.where(directions == 0, 1e-300, directions)
+
+    ## Walk down the tree for a batch of queries, as arrays of (query, node) pairs. Pairs
+    ## failing keep(queries, nodes) are dropped, and pairs reaching leaves are passed to
+    ## visit(queries, triangles) as (query, triangle) pairs. The pairs wait on a stack and are
+    ## taken max_pairs at a time, deepest first, so memory stays bounded however many nodes
+    ## each query has to visit.
+    def traverse(self, num_queries, keep, visit):
+
+        stack = [(np.arange(num_queries), np.zeros(num_queries, dtype=np.int64))]
+        leaf_batch = max(BVH.max_pairs // self.leaf_size, 1)
+        while stack:
+            queries, nodes = stack.pop()
+            if len(queries) > BVH.max_pairs:
+                stack.append((queries[BVH.max_pairs:], nodes[BVH.max_pairs:]))
+                queries, nodes = queries[:BVH.max_pairs], nodes[:BVH.max_pairs]
+
+            kept = keep(queries, nodes)
+            queries = queries[kept]
+            nodes = nodes[kept]
+
+            at_leaf = self.left[nodes] < 0
+            leaf_queries, leaves = queries[at_leaf], nodes[at_leaf]
+            for i in range(0, len(leaves), leaf_batch):
+                pair_queries, tris = self.leaf_pairs(leaf_queries[i:i + leaf_batch], leaves[i:i + leaf_batch])
+                if len(tris) > 0:
+                    visit(pair_queries, tris)
+
+            inner = ~at_leaf
+            if inner.any():
+                stack.append((np.concatenate([queries[inner], queries[inner]]),
+                              np.concatenate([self.left[nodes[inner]], self.right[nodes[inner]]])))
+
+    ## Expand (query, leaf) pairs into (query, triangle) pairs
+    def leaf_pairs(self, queries, leaves):
+
+        counts = self.stop[leaves] - self.start[leaves]
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return np.repeat(queries, counts), np.repeat(self.start[leaves], counts) + offsets
+
+    ## Reduce values over (query, triangle) pairs to the least value for each query, returning
+    ## the pair index of each minimum and the query it belongs to
+    def pair_minima(queries, values):
+
+        order = np.lexsort((values, queries))
+        firsts = order[np.r_[True, queries[order][1:] != queries[order][:-1]]]
+        return firsts, queries[firsts]
+
+    ## Find where each of an array of rays first hits the surface, as the distance along the
+    ## ray (in units of its direction vector) and the index of the face hit, or inf and -1
+    def ray_intersect(self, origins, directions):
+
+        ov = np.asarray(origins, dtype=float).reshape(-1, 3)
+        dv = np.array(np.broadcast_to(np.asarray(directions, dtype=float), ov.shape))
+        inv = BVH.inverse_directions(dv)
+        best_t = np.full(len(ov), np.inf)
+        best_tri = np.full(len(ov), -1)
+
+        def keep(queries, nodes):
+            t_near, t_far = self.box_hits(nodes, ov[queries], inv[queries])
+            return (t_near <= t_far) & (t_far >= 0) & (t_near <= best_t[queries])
+
+        def visit(queries, tris):
+            a, b, c = self.triangles[tris, 0], self.triangles[tris, 1], self.triangles[tris, 2]
+            t = ray_triangle_distances(ov[queries], dv[queries], a, b, c)
+            firsts, rays = BVH.pair_minima(queries, t)
+            closer = t[firsts] < best_t[rays]
+            best_t[rays[closer]] = t[firsts[closer]]
+            best_tri[rays[closer]] = tris[firsts[closer]]
+
+        self.traverse(len(ov), keep, visit)
+
+        face_ids = np.full(len(ov), -1)
+        hit = best_tri >= 0
+        face_ids[hit] = self.face_ids[best_tri[hit]]
+        return best_t, face_ids
+
+    ## Find the closest point on the surface to each of an array of points, returning the
+    ## closest points, their distances and the indices of the faces they lie on
+    def closest_points(self, pts):
+
+        pv = np.asarray(pts, dtype=float).reshape(-1, 3)
+        if len(self.triangles) == 0:
+            return np.full_like(pv, np.nan), np.full(len(pv), np.inf), np.full(len(pv), -1)
+
+        best_d2 = np.full(len(pv), np.inf)
+        best_pts = np.zeros_like(pv)
+        best_tri = np.full(len(pv), -1)
+
+        def visit(queries, tris):
+            a, b, c = self.triangles[tris, 0], self.triangles[tris, 1], self.triangles[tris, 2]
+            cv = closest_points_on_triangles(pv[queries], a, b, c)
+            d2 = np.sum((cv - pv[queries])**2, axis=1)
+            firsts, points = BVH.pair_minima(queries, d2)
+            closer = d2[firsts] < best_d2[points]
+            best_d2[points[closer]] = d2[firsts[closer]]
+            best_pts[points[closer]] = cv[firsts[closer]]
+            best_tri[points[closer]] = tris[firsts[closer]]
+
+        ## Start from the leaf each point reaches by always stepping toward the nearer box
+        ## center, so that the full search begins with a close bound on every point's distance.
+        ## The points descend in blocks sized like the leaf batches of traverse.
+        leaf_batch = max(BVH.max_pairs // self.leaf_size, 1)
+        for first in range(0, len(pv), leaf_batch):
+            block = np.arange(first, min(first + leaf_batch, len(pv)))
+            leaves = np.zeros(len(block), dtype=np.int64)
+            inner = self.left[leaves] >= 0
+            while inner.any():
+                l, r = self.left[leaves[inner]], self.right[leaves[inner]]
+                q = pv[block[inner]]
+                to_left = np.sum(((self.lo[l] + self.hi[l]) / 2 - q)**2, axis=1)
+                to_right = np.sum(((self.lo[r] + self.hi[r]) / 2 - q)**2, axis=1)
+                leaves[inner] = np.where(to_left <= to_right, l, r)
+                inner = self.left[leaves] >= 0
+            visit(*self.leaf_pairs(block, leaves))
+
+        def keep(queries, nodes):
+            return self.box_distances(nodes, pv[queries]) < best_d2[queries]
+
+        self.traverse(len(pv), keep, visit)
+
+        return best_pts, np.sqrt(best_d2), self.face_ids[best_tri]
+
+    ## Compute the winding number of the surface about each of an array of points, by
+    ## counting the signed crossings of a ray cast from each point
+    def winding_numbers(self, pts):
+
+        pv = np.asarray(pts, dtype=float).reshape(-1, 3)
+        dv = BVH.winding_direction
+        inv = BVH.inverse_directions(dv)
+        windings = np.zeros(len(pv), dtype=np.int64)
+
+        def keep(queries, nodes):
+            t_near, t_far = self.box_hits(nodes, pv[queries], inv)
+            return (t_near <= t_far) & (t_far >= 0)
+
+        ## Leaving through a face counts +1, entering through one counts -1
+        def visit(queries, tris):
+            a, b, c = self.triangles[tris, 0], self.triangles[tris, 1], self.triangles[tris, 2]
+            t = ray_triangle_distances(pv[queries], dv, a, b, c)
+            crossings = (t > 0) & (t < np.inf)
+            signs = np.sign(self.normals[tris] @ dv).astype(np.int64)
+            np.add.at(windings, queries[crossings], signs[crossings])
+
+        self.traverse(len(pv), keep, visit)
+
+        return windings
+
+    ## Determine which of an array of points lie inside the solid, counting a point as
+    ## inside wherever the surface winds around it a nonzero number of times
+    def contains(self, pts):
+
+        return self.winding_numbers(pts) != 0
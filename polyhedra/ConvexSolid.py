@@ -1,6 +1,10 @@
+import os
+import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
 from .Solid import *
 from .tools import *
+from .SolidCache import cached_solid
 
 class ConvexSolid(Solid):
 
@@ -13,6 +17,301 @@ class ConvexSolid(Solid):
 
         return all([not(f.is_visible(p)) for f in self.faces])
 
+    ## Return the faces of this ConvexSolid as half-spaces n.x <= d, as an array of
+    ## outward unit normals n and an array of offsets d
+    def halfspaces(self):
+
+        normals, centers = self.face_planes(self.faces)
+        offsets = np.einsum('ij,ij->i', normals, centers)
+
+        return normals, offsets
+
+    ## Return the unit normals and centers of a list of faces. The normals are found by
+    ## Newell's method, which stays well defined when some of a face's vertices are collinear.
+    def face_planes(self, faces):
+
+        if len(faces) == 0:
+            return np.zeros((0, 3)), np.zeros((0, 3))
+
+        sides = np.asarray([f.num_sides for f in faces])
+        all_ids = [id for f in faces for id in f.vertex_ids]
+        starts = np.cumsum(sides) - sides
+        next_pos = np.arange(len(all_ids)) + 1
+        next_pos[starts + sides - 1] = starts
+
+        ## Measure from the face centers, as Face.is_visible does, to keep the sums accurate
+        corners = np.asarray([self.vertices[id] for id in all_ids], dtype=float).reshape(-1, 3)
+        centers = np.add.reduceat(corners, starts) / sides[:, None]
+        corners = corners - np.repeat(centers, sides, axis=0)
+        normals = np.add.reduceat(np.cross(corners, corners[next_pos]), starts)
+        normals = normals / np.linalg.norm(normals, axis=1)[:, None]
+
+        return normals, centers
+
+    ## For each of an array of points, find how far it lies beyond the face it is furthest
+    ## outside of (negative for interior points), and the index of that face
+    def face_heights(self, pts, block=64):
+
+        pv = np.asarray(pts, dtype=float).reshape(-1, 3)
+        normals, offsets = self.halfspaces()
+        heights = np.full(len(pv), -np.inf)
+        face_ids = np.zeros(len(pv), dtype=np.int64)
+
+        ## Work through the faces a block at a time to keep memory bounded
+        for start in range(0, len(normals), block):
+            block_heights = pv @ normals[start:start + block].T - offsets[start:start + block]
+            block_max = block_heights.max(axis=1)
+            higher = block_max > heights
+            heights[higher] = block_max[higher]
+            face_ids[higher] = start + block_heights[higher].argmax(axis=1)
+
+        return heights, face_ids
+
+    ## Add an array of vertices to the hull of this ConvexSolid at once. Unless tidy, the
+    ## vertices swallowed up by the hull are left for the caller to clear away.
+    def add_hull_vertices(self, pts, tidy=True):
+
+        pv = np.asarray(pts, dtype=float).reshape(-1, 3)
+        heights, face_ids = self.face_heights(pv)
+
+        while True:
+            outside = heights > self.error
+            if not outside.any(): break
+            pv = pv[outside]
+            heights = heights[outside]
+            face_ids = face_ids[outside]
+
+            ## Add the furthest point beyond each face, then discard whatever that swallowed
+            faces = self.faces
+            order = np.lexsort((-heights, face_ids))
+            firsts = order[np.r_[True, face_ids[order][1:] != face_ids[order][:-1]]]
+            for i in firsts:
+                face = faces[face_ids[i]]
+                if face.solid is self and self.heights_above([face], pv[i])[0] > self.error:
+                    self.insert_hull_vertex(pv[i], face, tidy=False)
+            self.faces = [f for f in self.faces if f.solid is self]
+            heights, face_ids = self.face_heights(pv)
+
+        if tidy:
+            self.tidy_hull()
+
+        return self
+
+    ## Add a vertex to the hull in place, given a face that is visible from it. Unless tidy,
+    ## the faces and vertices swallowed up by the hull are left for the caller to clear away.
+    def insert_hull_vertex(self, vertex, face, tidy=True):
+
+        pv = np.asarray(vertex, dtype=float)
+
+        ## Grow the visible region outward from the given face, a ring of neighbors at a time.
+        ## Faces the vertex is coplanar with join the region too, so that no new face is ever
+        ## a sliver folded against a neighbor. A face only joins if the region stays a disk,
+        ## which near-coplanar faces could otherwise break by pinching it at a vertex.
+        visible_faces = [face]
+        region = {face}
+        region_edges = set(face.edges)
+        boundary_count = {id: 1 for id in face.vertex_ids}
+        seen = {face}
+        frontier = [face]
+        waiting = []
+        while frontier:
+            candidates = []
+            for f in frontier:
+                for id1, id2 in f.edges:
+                    adj_face = self.faces_by_edge[id2][id1]
+                    if adj_face not in seen:
+                        seen.add(adj_face)
+                        candidates.append(adj_face)
+            heights = self.heights_above(candidates, pv)
+            waiting += [f for f, h in zip(candidates, heights) if h > -self.error]
+
+            frontier = []
+            growing = True
+            while growing:
+                growing = False
+                for f in waiting:
+                    if f in region or not ConvexSolid.extends_disk(f, region_edges, boundary_count):
+                        continue
+                    for id1, id2 in f.edges:
+                        if (id2, id1) in region_edges:
+                            boundary_count[id2] -= 1
+                        else:
+                            boundary_count[id1] = boundary_count.get(id1, 0) + 1
+                    region.add(f)
+                    region_edges.update(f.edges)
+                    frontier.append(f)
+                    growing = True
+                waiting = [f for f in waiting if f not in region]
+            visible_faces += frontier
+
+        ## Cone the horizon to the new vertex. The faces beyond the horizon lie over error above
+        ## the vertex (bar any kept out to leave the region a disk), so the new triangles are not
+        ## slivers; coplanar triangles are merged into polygons afterwards by tidy_hull.
+        horizon = Solid.boundary(visible_faces)
+        horiz_length = len(horizon)
+        new_id = self.add_vertex(pv, check_equality=False)
+        new_faces = [[horizon[i], horizon[(i + 1) % horiz_length], new_id] for i in range(horiz_length)]
+
+        for f in visible_faces:
+            for id1, id2 in f.edges:
+                del self.faces_by_edge[id1][id2]
+                self.faces_by_vertex[id1].remove(f)
+            f.solid = None
+
+        for ids in new_faces:
+            self.add_face([], ids=ids)
+
+        ## Edges that were interior to the removed region are gone
+        for f in visible_faces:
+            for id in f.vertex_ids:
+                self.edges[id] = set(self.faces_by_edge[id])
+
+        if tidy:
+            self.tidy_hull()
+
+        return self
+
+    ## Determine whether adding a face to a region of faces that forms a disk, given as its
+    ## directed edges and the number of boundary edges leaving each vertex, leaves it a disk
+    def extends_disk(face, region_edges, boundary_count):
+
+        shared = [(id2, id1) in region_edges for id1, id2 in face.edges]
+        num_sides = len(shared)
+
+        ## The face must meet the region along a single run of its edges, but not all of them
+        runs = sum(shared[i] and not shared[i - 1] for i in range(num_sides))
+        if runs != 1:
+            return False
+
+        ## Vertices away from that run must not already be on the boundary, or the region
+        ## would be pinched there
+        for i in range(num_sides):
+            if not shared[i] and not shared[i - 1] and boundary_count.get(face.vertex_ids[i], 0) > 0:
+                return False
+
+        return True
+
+    ## Merge the coplanar faces of the hull into polygons, and drop the vertices that are left
+    ## collinear with their neighbors or are no longer used by any face
+    def tidy_hull(self):
+
+        self.faces = [f for f in self.faces if f.solid is self]
+        vertices = np.asarray(self.vertices, dtype=float).reshape(-1, 3)
+        triangles = [[f.vertex_ids[0], f.vertex_ids[i], f.vertex_ids[i + 1]]
+                     for f in self.faces for i in range(1, f.num_sides - 1)]
+        faces = merge_coplanar_triangles(vertices, triangles, self.error)
+        faces = drop_collinear_vertices(vertices, faces, self.error)
+        self.overwrite(Solid.from_arrays(self.name, vertices, faces, error=self.error))
+
+        return self.remove_unused_vertices()
+
+    ## Find the heights of a given point above the planes of a list of faces
+    def heights_above(self, faces, standpoint):
+
+        normals, centers = self.face_planes(faces)
+
+        return np.einsum('ij,ij->i', normals, np.asarray(standpoint) - centers)
+
+    ## Return the part of this ConvexSolid inside all of a set of half-spaces n.x <= d, given as
+    ## arrays of normals n and offsets d, or None if nothing is left
+    def clip_halfspaces(self, normals, offsets, name=None):
+
+        vertices = np.asarray(self.vertices, dtype=float).reshape(-1, 3)
+        face_sizes = np.asarray([f.num_sides for f in self.faces])
+        face_ids = np.asarray([id for f in self.faces for id in f.vertex_ids])
+
+        for nv, d in zip(np.asarray(normals, dtype=float).reshape(-1, 3), np.ravel(offsets)):
+            clipped = clip_polytope(vertices, face_sizes, face_ids, nv, d, self.error)
+            if clipped is None:
+                return None
+            vertices, face_sizes, face_ids = clipped
+
+        faces = [ids.tolist() for ids in np.split(face_ids, np.cumsum(face_sizes)[:-1])]
+        cs = ConvexSolid(self.name if name is None else name)
+        return cs.overwrite(Solid.from_arrays(cs.name, vertices, faces, error=self.error))
+
+    ## Return the part of this ConvexSolid behind a plane, given as a point on the plane and
+    ## a normal pointing away from the part to keep, or None if nothing is left
+    def clip(self, plane, name=None):
+
+        plane_pt, plane_vec = plane
+        nv = np.asarray(plane_vec, dtype=float)
+        nv = nv / np.linalg.norm(nv)
+        return self.clip_halfspaces([nv], [np.dot(nv, plane_pt)], name)
+
+    ## Return the intersection of this ConvexSolid with one or more others, or None if
+    ## they do not overlap
+    def intersect(self, *others, name=None):
+
+        halfspaces = [other.halfspaces() for other in others]
+        normals = np.concatenate([h[0] for h in halfspaces])
+        offsets = np.concatenate([h[1] for h in halfspaces])
+
+        ## Rule out separated solids before doing any clipping
+        vertices = np.asarray(self.vertices, dtype=float).reshape(-1, 3)
+        if ((vertices @ normals.T - offsets).min(axis=0) > -self.error).any():
+            return None
+
+        return self.clip_halfspaces(normals, offsets, name)
+
+    ## Group the faces of this ConvexSolid by the direction of their normals, recording for
+    ## each group a cone containing its normals and its nearest approach to the center, so
+    ## that points can be ruled out against a whole group of faces at once
+    def face_groups(self, resolution=4):
+
+        normals, offsets = self.halfspaces()
+        center = self.center()
+        depths = offsets - normals @ center
+
+        ## Bin the normals by the cell of the cube they point through
+        axes = np.argmax(np.abs(normals), axis=1)
+        rows = np.arange(len(normals))
+        major = normals[rows, axes]
+        minor = normals[rows[:, None], (axes[:, None] + [1, 2]) % 3] / np.abs(major)[:, None]
+        cells = np.clip(((minor + 1) / 2 * resolution).astype(int), 0, resolution - 1)
+        keys = ((2 * axes + (major > 0)) * resolution + cells[:, 0]) * resolution + cells[:, 1]
+
+        groups = []
+        for key in np.unique(keys):
+            ids = np.flatnonzero(keys == key)
+            axis = normals[ids].sum(axis=0)
+            axis = axis / np.linalg.norm(axis)
+            cos_spread = np.clip((normals[ids] @ axis).min(), -1, 1)
+            groups.append((axis, cos_spread, depths[ids].min(), normals[ids], offsets[ids]))
+
+        return center, groups
+
+    ## Determine which of an array of points lie outside this ConvexSolid, using face groups
+    ## from face_groups to skip faces that cannot possibly be visible from each point
+    def outside_mask(self, pts, face_groups=None):
+
+        pv = np.asarray(pts, dtype=float).reshape(-1, 3)
+        center, groups = face_groups if face_groups is not None else self.face_groups()
+        outside = np.zeros(len(pv), dtype=bool)
+
+        ## Points within the inscribed ball about the center are inside every face
+        qv = pv - center
+        radii = np.linalg.norm(qv, axis=1)
+        near = np.flatnonzero(radii > min(g[2] for g in groups) + self.error)
+        qv = qv[near] / radii[near, None]
+        radii = radii[near]
+
+        for axis, cos_spread, depth, normals, offsets in groups:
+
+            ## A bound on how far the point reaches along any normal in the group's cone
+            cos_angle = qv @ axis
+            sin_angle = np.sqrt(np.clip(1 - cos_angle**2, 0, None))
+            sin_spread = np.sqrt(1 - cos_spread**2)
+            reach = np.where(cos_angle >= cos_spread, 1.0,
+                             cos_angle * cos_spread + sin_angle * sin_spread) * radii
+
+            ids = near[(reach > depth + self.error) & ~outside[near]]
+            if len(ids) > 0:
+                heights = pv[ids] @ normals.T - offsets
+                outside[ids] |= (heights > self.error).any(axis=1)
+
+        return outside
+
     ## Add a vertex to the hull of this ConvexSolid
     def add_hull_vertex(self, vertex):
 
@@ -78,6 +377,7 @@ class ConvexSolid(Solid):
         return cs
 
     ## Construct a ConvexSolid as a convex hull of a given set of points
+    @cached_solid("hull")
     def hull(name, pts, error=1e-7):
 
         pv1 = np.asarray(pts[0])
@@ -99,3 +399,101 @@ class ConvexSolid(Solid):
             cs.add_hull_vertex(p)
 
         return cs
+
+    ## Find four widely separated points among an array of points that span a tetrahedron
+    ## more than error high, or return None if the points all lie in one plane
+    def seed_tetrahedron(pts, error=1e-7):
+
+        pv = np.asarray(pts, dtype=float).reshape(-1, 3)
+        if len(pv) < 4:
+            return None
+
+        ## Start from the extreme points, though the rest are searched too, since the extreme
+        ## points can all lie in one plane when the others do not
+        seeds = extreme_points(pv)
+        far1 = np.argmax(np.linalg.norm(seeds - seeds[0], axis=1))
+        line = seeds[far1] - seeds[0]
+        far2 = np.argmax(np.linalg.norm(np.cross(pv - seeds[0], line), axis=1))
+        nv = np.cross(line, pv[far2] - seeds[0])
+        heights = np.abs((pv - seeds[0]) @ nv)
+        far3 = np.argmax(heights)
+        if heights[far3] <= error * np.linalg.norm(nv):
+            return None
+
+        return seeds[0], seeds[far1], pv[far2], pv[far3]
+
+    ## Construct a ConvexSolid as the convex hull of a point cloud too large to hold in memory,
+    ## given as a path to a binary file of xyz coords (or a .npy file), an array, or an iterable
+    ## of chunks of points. Interior points are discarded a chunk at a time before they reach
+    ## the hull, first using the extreme points of the first chunk and then the hull itself.
+    def hull_stream(name, source, chunk_size=1 << 16, dtype=np.float64, error=1e-7):
+
+        cs = None
+        pending = np.zeros((0, 3))
+
+        for chunk in iter_point_chunks(source, chunk_size, dtype):
+
+            if len(chunk) == 0: continue
+
+            if cs is None:
+                pv = np.concatenate([pending, chunk])
+                tetrahedron = ConvexSolid.seed_tetrahedron(pv, error)
+                if tetrahedron is None:
+                    pending = pv
+                    continue
+
+                cs = ConvexSolid.tetrahedron(name, *tetrahedron)
+                cs.error = error
+                cs.add_hull_vertices(extreme_points(pv), tidy=False)
+                chunk = pv
+
+            cs.add_hull_vertices(chunk[cs.outside_mask(chunk)], tidy=False)
+
+        if cs is None:
+            raise ValueError("the points must include four that are not coplanar")
+
+        return cs.tidy_hull()
+
+    ## Construct a ConvexSolid as the convex hull of an array of points by splitting it
+    ## across a pool of processes, hulling each part separately and then hulling the union
+    ## of the parts' hull vertices. The points reach the workers through shared memory.
+    @cached_solid("hull_parallel", ignore=("processes",))
+    def hull_parallel(name, pts, processes=None, error=1e-7):
+
+        pv = np.asarray(pts, dtype=float).reshape(-1, 3)
+        processes = processes or os.cpu_count()
+        bounds = np.linspace(0, len(pv), processes + 1).astype(int)
+
+        shm = shared_memory.SharedMemory(create=True, size=max(pv.nbytes, 1))
+        try:
+            shared = np.ndarray(pv.shape, dtype=pv.dtype, buffer=shm.buf)
+            shared[:] = pv
+            del shared
+            jobs = [(shm.name, pv.shape, pv.dtype.str, start, stop, error)
+                    for start, stop in zip(bounds[:-1], bounds[1:])]
+            with multiprocessing.Pool(processes) as pool:
+                partial_hulls = pool.starmap(hull_shared_slice, jobs)
+        finally:
+            shm.close()
+            shm.unlink()
+
+        partial_hulls = [pv[start:stop] if vertices is None else vertices
+                         for (start, stop), vertices in zip(zip(bounds[:-1], bounds[1:]), partial_hulls)]
+        return ConvexSolid.hull_stream(name, np.concatenate(partial_hulls), error=error)
+
+## Hull a slice of a point array held in shared memory, returning the hull's vertices, or None
+## if the slice lies in one plane and so has to be passed on whole
+def hull_shared_slice(shm_name, shape, dtype, start, stop, error):
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        pts = np.ndarray(shape, dtype=dtype, buffer=shm.buf)[start:stop]
+        if ConvexSolid.seed_tetrahedron(pts, error) is None:
+            vertices = None
+        else:
+            vertices = np.asarray(ConvexSolid.hull_stream("part", pts, error=error).vertices)
+        del pts
+    finally:
+        shm.close()
+
+    return vertices
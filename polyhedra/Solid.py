@@ -1,6 +1,11 @@
+import gc
+import functools
+import itertools
 import numpy as np
 import os
 from .tools import *
+from .BVH import BVH
+from .SolidCache import cached_solid, cached_bytes
 from .location import __location__
 
 class Triangle:
@@ -32,11 +37,22 @@ class Face:
 
         self.vertex_ids = vertex_ids[:]
         self.num_sides = len(self.vertex_ids)
-        self.vertex_lookup = { self.vertex_ids[index]: index for index in range(self.num_sides) }
-        self.edges = [(self.get_id(i), self.get_id(i+1)) for i in range(self.num_sides)]
 
         self.solid = supersolid
 
+    ## The position of each vertex ID in the face, worked out when first needed since
+    ## meshes read from files can have millions of faces
+    @functools.cached_property
+    def vertex_lookup(self):
+
+        return dict(zip(self.vertex_ids, range(self.num_sides)))
+
+    ## The directed edges of the face, as pairs of vertex IDs
+    @functools.cached_property
+    def edges(self):
+
+        return list(zip(self.vertex_ids, self.vertex_ids[1:] + self.vertex_ids[:1]))
+
     ## Set the Solid that this face belongs to
     def set_supersolid(self, supersolid):
 
@@ -270,6 +286,18 @@ class Solid:
 
         return self
 
+    ## Remove vertices that no longer belong to any face, renumbering the rest
+    def remove_unused_vertices(self):
+
+        used = sorted({id for f in self.faces for id in f.vertex_ids})
+        if len(used) == self.num_vertices:
+            return self
+
+        new_ids = {id: index for index, id in enumerate(used)}
+        faces = [[new_ids[id] for id in f.vertex_ids] for f in self.faces]
+        vertices = [self.vertices[id] for id in used]
+        return self.overwrite(Solid.from_arrays(self.name, vertices, faces, error=self.error))
+
     ## Translate this Solid by a given vector
     def translate(self, trans):
 
@@ -290,6 +318,7 @@ class Solid:
 
     ## Return the dual of this Solid
     ## WARNING: The result may have degenerate faces
+    @cached_solid("conway_dual")
     def conway_dual(self):
 
         s = Solid(self.name)
@@ -303,6 +332,7 @@ class Solid:
 
     ## Return the Solid formed by applying the conway "kis" operator to this Solid
     ## with a specified outward/inward offset
+    @cached_solid("conway_kis")
     def conway_kis(self, distance):
 
         s = Solid(self.name)
@@ -321,6 +351,7 @@ class Solid:
 
     ## Returns the Solid formed by applying the conway "truncate" operator to this Solid
     ## with each cut depth equal to a given proportion of the maximum depth
+    @cached_solid("conway_truncate")
     def conway_truncate(self, proportion):
 
         s = self.copy(self.name)
@@ -343,6 +374,7 @@ class Solid:
 
         return self.conway_snub(distance, 0)
 
+    @cached_solid("conway_snub")
     def conway_snub(self, distance, twist):
 
         s = Solid(self.name)
@@ -433,6 +465,12 @@ class Solid:
         if n > 1: return self.smooth_faces(n-1)
         else: return self
 
+    ## Build a bounding volume hierarchy over the faces of this Solid, for ray casting,
+    ## closest-point and containment queries (rebuild it after changing the Solid)
+    def bvh(self, leaf_size=8):
+
+        return BVH(self, leaf_size)
+
     ## Generate the Triangles for each face, to be used for STL generation
     def build(self):
 
@@ -449,13 +487,18 @@ class Solid:
         if os.path.exists(filename): os.remove(filename)
         file = open(filename, "a")
 
-        filetext = ""
-        filetext += "solid " + self.name + "\n"
-        for t in self.triangles:
-            filetext += t.to_stl()
-        filetext += "endsolid " + self.name + "\n"
-
-        file.write(filetext)
+        def build_text():
+            filetext = ""
+            filetext += "solid " + self.name + "\n"
+            for t in self.triangles:
+                filetext += t.to_stl()
+            filetext += "endsolid " + self.name + "\n"
+            return filetext.encode()
+
+        ## The text only depends on the name and the triangle coordinates
+        coords = [[t.p1, t.p2, t.p3] for t in self.triangles]
+        arguments = {"name": self.name, "triangles": np.reshape(coords, (-1, 3, 3))}
+        file.write(cached_bytes("gen_file", arguments, build_text, self.error).decode())
         file.close()
 
         return self
@@ -496,6 +539,80 @@ class Solid:
 
         return s
 
+    ## Build a new Solid from an array of vertex coords and a list of faces given as vertex IDs
+    def from_arrays(name, vertices, faces, error=1.0e-7):
+
+        ## The garbage collector would otherwise rescan the growing tables over and over while
+        ## millions of small objects are made, which for large meshes takes most of the time
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return Solid.fill_from_arrays(Solid(name, error=error), vertices, faces)
+        finally:
+            if gc_enabled: gc.enable()
+
+    ## Fill in the vertices, faces and lookup tables of an empty Solid from arrays
+    def fill_from_arrays(s, vertices, faces):
+
+        ## Fill in the lookup tables directly, since the IDs are already known to be distinct
+        s.vertices = list(np.array(vertices, dtype=float).reshape(-1, 3))
+        s.num_vertices = len(s.vertices)
+        s.faces = [Face(list(ids), s) for ids in faces]
+
+        ## Sort every directed edge of every face by its starting vertex, so that each vertex's
+        ## entries in the tables are one slice of the sorted arrays
+        vertex_ids = [f.vertex_ids for f in s.faces]
+        sides = np.fromiter(map(len, vertex_ids), dtype=np.int64, count=len(vertex_ids))
+        num_corners = int(sides.sum())
+        corner_ids = np.fromiter(itertools.chain.from_iterable(vertex_ids), dtype=np.int64, count=num_corners)
+        face_starts = np.cumsum(sides) - sides
+        next_pos = np.arange(num_corners) + 1
+        next_pos[face_starts + sides - 1] = face_starts
+        prev_pos = np.empty(num_corners, dtype=np.int64)
+        prev_pos[next_pos] = np.arange(num_corners)
+
+        order = np.argsort(corner_ids, kind='stable')
+        bounds = np.searchsorted(corner_ids[order], np.arange(s.num_vertices + 1)).tolist()
+        owners = [s.faces[index] for index in np.repeat(np.arange(len(s.faces)), sides)[order].tolist()]
+        next_ids = corner_ids[next_pos][order].tolist()
+        neighbors = np.column_stack([corner_ids[next_pos], corner_ids[prev_pos]])[order].ravel().tolist()
+
+        slices = [slice(bounds[id], bounds[id + 1]) for id in range(s.num_vertices)]
+        s.faces_by_vertex = [owners[sl] for sl in slices]
+        s.faces_by_edge = [dict(zip(next_ids[sl], owners[sl])) for sl in slices]
+        s.edges = [set(neighbors[2 * bounds[id]:2 * bounds[id + 1]]) for id in range(s.num_vertices)]
+
+        return s
+
+    ## Load an ASCII or binary STL file into a new Solid and return it, welding vertices
+    ## closer than the given error and optionally merging coplanar triangles into polygons
+    def from_stl(filename, name, merge_faces=False, error=1.0e-7):
+
+        triangle_coords = read_stl(filename)
+        vertices, inverse = weld_vertices(triangle_coords, error)
+        triangles = inverse.reshape(-1, 3)
+
+        ## Drop triangles that collapsed to an edge or a point when welded
+        nondegenerate = ((triangles[:, 0] != triangles[:, 1])
+                         & (triangles[:, 1] != triangles[:, 2])
+                         & (triangles[:, 2] != triangles[:, 0]))
+        triangles = triangles[nondegenerate]
+
+        ## Discard vertices no longer used by any face (e.g. centers of merged fans)
+        if merge_faces:
+            faces = merge_coplanar_triangles(vertices, triangles, error)
+            sides = [len(ids) for ids in faces]
+            used, corner_ids = np.unique(np.fromiter((id for ids in faces for id in ids), dtype=np.int64,
+                                                     count=sum(sides)), return_inverse=True)
+            corner_ids = corner_ids.tolist()
+            ends = np.cumsum(sides).tolist()
+            faces = [corner_ids[end - side:end] for end, side in zip(ends, sides)]
+        else:
+            used, corner_ids = np.unique(triangles, return_inverse=True)
+            faces = corner_ids.reshape(-1, 3).tolist()
+
+        return Solid.from_arrays(name, vertices[used], faces, error=error)
+
     ## Given a bunch of faces, find the exposed boundary, assuming it is contiguous
     def boundary(faces):
 
@@ -0,0 +1,266 @@
+import os
+import time
+import hashlib
+import inspect
+import tempfile
+import warnings
+import zipfile
+import functools
+import numpy as np
+
+## The cache consulted by the cached operations, or None while caching is disabled
+active_cache = None
+
+## Bumped whenever the entry layout or the hashed encoding changes
+cache_format = 1
+
+class SolidCache:
+
+    ## Temporary files untouched for this many seconds were left by writers that died
+    stale_age = 3600
+
+    def __init__(self, directory, max_size=1 << 30):
+
+        self.directory = os.path.realpath(directory)
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    ## Return the hex digest identifying an operation applied to the given arguments,
+    ## where Solids and arrays are hashed by their geometry quantized by the error
+    def key(self, operation, arguments, error=1.0e-7):
+
+        from . import __version__
+
+        digest = hashlib.sha256()
+        digest.update(("polyhedra %s %d %s\n" % (__version__, cache_format, operation)).encode())
+        for arg_name in sorted(arguments):
+            digest.update(("%s=" % arg_name).encode())
+            update_digest(digest, arguments[arg_name], error)
+            digest.update(b"\n")
+
+        return digest.hexdigest()
+
+    def path(self, key):
+
+        return os.path.join(self.directory, key + ".npz")
+
+    ## Return the arrays stored under a key as a dict, or None on a miss
+    def get(self, key):
+
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                arrays = {k: entry[k] for k in entry.files}
+        except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+
+        ## Mark the entry as recently used, which is what eviction goes by
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return arrays
+
+    ## Store arrays under a key, replacing the file atomically so that concurrent
+    ## processes never see a partial entry, then evict down to the size limit. A cache
+    ## that cannot be written to (a full disk, say) only gives a warning, and the key
+    ## is returned only if the entry was stored.
+    def put(self, key, arrays):
+
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+            with os.fdopen(fd, "wb") as file:
+                np.savez_compressed(file, **arrays)
+            os.replace(temp_path, self.path(key))
+            temp_path = None
+            self.evict()
+        except OSError as e:
+            warnings.warn("could not write to the solid cache: %s" % e, RuntimeWarning)
+            return None
+        finally:
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+        return key
+
+    ## Remove the least recently used entries until the cache fits in max_size bytes
+    def evict(self):
+
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size: break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+        return self
+
+    ## Return the total size in bytes of the stored entries
+    def size(self):
+
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory)
+                   if entry.name.endswith(".npz"))
+
+    ## Remove every entry, along with temporary files left behind by writers that died.
+    ## Other processes' writes in progress are left alone.
+    def clear(self):
+
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.endswith(".npz"):
+                    os.remove(entry.path)
+                elif entry.name.endswith(".tmp") and now - entry.stat().st_mtime > SolidCache.stale_age:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+        return self
+
+    ## Return the cached Solid stored under a key, or None on a miss
+    def get_solid(self, key, name):
+
+        arrays = self.get(key)
+        if arrays is None:
+            return None
+
+        return arrays_to_solid(arrays, name)
+
+    def put_solid(self, key, solid):
+
+        return self.put(key, solid_to_arrays(solid))
+
+## Start caching the results of the cached operations in a directory, evicting the least
+## recently used entries beyond max_size bytes, and return the SolidCache
+def enable_cache(directory, max_size=1 << 30):
+
+    global active_cache
+    active_cache = SolidCache(directory, max_size)
+    return active_cache
+
+def disable_cache():
+
+    global active_cache
+    active_cache = None
+
+## Feed a canonical encoding of a value to a hash: Solids as quantized vertices plus face
+## indices, numeric arrays as quantized coordinates and anything else by its repr
+def update_digest(digest, value, error):
+
+    from .Solid import Solid
+
+    if isinstance(value, Solid):
+        digest.update(("solid %r " % value.error).encode())
+        vertices = np.asarray(value.vertices, dtype=float).reshape(-1, 3)
+        face_sizes = np.array([f.num_sides for f in value.faces], dtype=np.int64)
+        face_ids = np.array([id for f in value.faces for id in f.vertex_ids], dtype=np.int64)
+        update_digest_array(digest, vertices, value.error)
+        digest.update(face_sizes.tobytes())
+        digest.update(face_ids.tobytes())
+    elif value is None or isinstance(value, (bool, int, float, str, np.number)):
+        digest.update(repr(value).encode())
+    else:
+        update_digest_array(digest, np.asarray(value, dtype=float), error)
+
+def update_digest_array(digest, array, error):
+
+    quantized = np.round(array / error).astype(np.int64)
+    digest.update(("array %r " % (quantized.shape,)).encode())
+    digest.update(np.ascontiguousarray(quantized).tobytes())
+
+def solid_to_arrays(solid):
+
+    from .ConvexSolid import ConvexSolid
+
+    return {
+        "kind": np.array("ConvexSolid" if isinstance(solid, ConvexSolid) else "Solid"),
+        "error": np.array(solid.error),
+        "vertices": np.asarray(solid.vertices, dtype=float).reshape(-1, 3),
+        "face_sizes": np.array([f.num_sides for f in solid.faces], dtype=np.int32),
+        "face_ids": np.array([id for f in solid.faces for id in f.vertex_ids], dtype=np.int32),
+    }
+
+def arrays_to_solid(arrays, name):
+
+    from .Solid import Solid
+    from .ConvexSolid import ConvexSolid
+
+    ends = np.cumsum(arrays["face_sizes"])
+    faces = np.split(arrays["face_ids"], ends[:-1]) if len(ends) else []
+    solid = Solid.from_arrays(name, arrays["vertices"], [f.tolist() for f in faces],
+                              error=float(arrays["error"]))
+
+    if str(arrays["kind"]) == "ConvexSolid":
+        return ConvexSolid(name).overwrite(solid)
+
+    return solid
+
+## Decorator caching an operation that returns a Solid: the key covers every argument
+## except "name" and those listed in ignore (ones that cannot change the result), and
+## a hit is named after the name argument or the input Solid
+def cached_solid(operation, ignore=()):
+
+    def decorator(method):
+
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+
+            cache = active_cache
+            if cache is None:
+                return method(*args, **kwargs)
+
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = {k: v for k, v in bound.arguments.items() if k not in ignore}
+            if "name" in arguments:
+                name = arguments.pop("name")
+            else:
+                name = arguments["self"].name
+
+            key = cache.key(operation, arguments, arguments.get("error", 1.0e-7))
+            solid = cache.get_solid(key, name)
+            if solid is None:
+                solid = method(*args, **kwargs)
+                if solid is not None:
+                    cache.put_solid(key, solid)
+
+            return solid
+
+        return wrapper
+
+    return decorator
+
+## Return the bytes of a generated file, from the active cache when the same operation
+## on the same arguments was seen before, otherwise from build() (which returns bytes)
+def cached_bytes(operation, arguments, build, error=1.0e-7):
+
+    cache = active_cache
+    if cache is None:
+        return build()
+
+    key = cache.key(operation, arguments, error)
+    arrays = cache.get(key)
+    if arrays is not None:
+        return arrays["data"].tobytes()
+
+    data = build()
+    cache.put(key, {"data": np.frombuffer(data, dtype=np.uint8)})
+    return data
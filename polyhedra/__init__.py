@@ -6,6 +6,8 @@ __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file
 
 from .tools import *
 from .Solid import Solid
+from .BVH import BVH
+from .SolidCache import SolidCache, enable_cache, disable_cache
 from .ConvexSolid import ConvexSolid
 from .PlatonicSolid import PlatonicSolid
 from .ArchimedeanSolid import ArchimedeanSolid
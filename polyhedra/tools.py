@@ -1,3 +1,5 @@
+import os
+import re
 import numpy as np
 
 def stringify_vec(vec):
@@ -31,3 +33,326 @@ def rotate_about_line(point, base_pt, vec, theta):
     rv2 = rv2 * np.linalg.norm(rv1) / np.linalg.norm(rv2)
     new_pv = projv + rv1 * np.cos(theta) + rv2 * np.sin(theta)
     return new_pv
+
+## Binary STL layout: an 80-byte header and a triangle count, then 50-byte records
+stl_header_size = 84
+stl_dtype = np.dtype([
+    ('normal', '<f4', (3,)),
+    ('vertices', '<f4', (3, 3)),
+    ('attr', '<u2')
+])
+
+def read_stl(filename):
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as file:
+        header = file.read(stl_header_size)
+
+    ## A binary file is its records plus, from some exporters, trailing padding. ASCII files
+    ## start with "solid", though binary headers sometimes do too, so those are only read as
+    ## binary when they match the record count exactly or hold no text vertices.
+    count = -1
+    if len(header) == stl_header_size:
+        count = int(np.frombuffer(header, dtype='<u4', offset=80)[0])
+    binary_size = stl_header_size + count * stl_dtype.itemsize
+    is_binary = count >= 0 and (size == binary_size or (size > binary_size and not header.startswith(b'solid')))
+
+    if not is_binary:
+        try:
+            with open(filename, 'r') as file:
+                coords = re.findall(r'vertex\s+(\S+)\s+(\S+)\s+(\S+)', file.read())
+        except UnicodeDecodeError:
+            coords = None
+        if coords or count <= 0 or size < binary_size:
+            if coords is None:
+                raise ValueError("%s is neither an ASCII nor a binary STL file" % filename)
+            return np.asarray(coords, dtype=float).reshape(-1, 3, 3)
+
+    if count == 0:
+        return np.zeros((0, 3, 3))
+    records = np.memmap(filename, dtype=stl_dtype, mode='r', offset=stl_header_size, shape=(count,))
+    return records['vertices']
+
+def weld_vertices(pts, error):
+    pv = np.asarray(pts, dtype=float).reshape(-1, 3)
+    if len(pv) == 0:
+        return np.zeros((0, 3)), np.zeros(0, dtype=np.int64)
+    keys = np.round(pv / error).astype(np.int64)
+    order = np.lexsort(keys.T[::-1])
+    sorted_keys = keys[order]
+    is_first = np.ones(len(pv), dtype=bool)
+    is_first[1:] = (sorted_keys[1:] != sorted_keys[:-1]).any(axis=1)
+    inverse = np.empty(len(pv), dtype=np.int64)
+    inverse[order] = np.cumsum(is_first) - 1
+    return pv[order[is_first]], inverse
+
+def merge_coplanar_triangles(vertices, triangles, error):
+    tv = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+    num_tris = len(tv)
+    if num_tris == 0:
+        return []
+
+    p0 = vertices[tv[:, 0]]
+    normals = np.cross(vertices[tv[:, 1]] - p0, vertices[tv[:, 2]] - p0)
+    normals = normals / np.linalg.norm(normals, axis=1)[:, None]
+
+    ## Pair each directed edge (a, b) with its reverse (b, a) on the neighboring triangle
+    starts = tv.reshape(-1)
+    ends = tv[:, [1, 2, 0]].reshape(-1)
+    owners = np.repeat(np.arange(num_tris), 3)
+    num_verts = len(vertices)
+    keys = starts * num_verts + ends
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    reverse_keys = ends * num_verts + starts
+    pos = np.minimum(np.searchsorted(sorted_keys, reverse_keys), num_tris * 3 - 1)
+    matched = sorted_keys[pos] == reverse_keys
+    t1 = owners[matched]
+    t2 = owners[order[pos[matched]]]
+
+    ## Neighbors are coplanar if each lies in the plane of the other
+    opposite = tv[t2, 0] + tv[t2, 1] + tv[t2, 2] - starts[matched] - ends[matched]
+    d1 = np.einsum('ij,ij->i', normals[t1], vertices[opposite] - vertices[starts[matched]])
+    coplanar = (np.abs(d1) < error) & (np.einsum('ij,ij->i', normals[t1], normals[t2]) > 0)
+    t1 = t1[coplanar]
+    t2 = t2[coplanar]
+
+    ## Label connected coplanar patches by min-label propagation with pointer jumping
+    labels = np.arange(num_tris)
+    while True:
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, t1, labels[t2])
+        np.minimum.at(new_labels, t2, labels[t1])
+        new_labels = new_labels[new_labels]
+        if (new_labels == labels).all(): break
+        labels = new_labels
+
+    polygons = []
+    order = np.argsort(labels, kind='stable')
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+
+    ## Neighbors can each be coplanar while the patch bends; patches whose corners stray over
+    ## error from the plane through their center, along their area-weighted normal, keep their
+    ## triangles
+    firsts = np.r_[0, bounds]
+    corners = vertices[tv[order]]
+    sizes = np.diff(np.r_[firsts, num_tris])
+    centers = np.add.reduceat(corners.sum(axis=1), firsts) / (3 * sizes)[:, None]
+    plane_vecs = np.add.reduceat(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), firsts)
+    plane_vecs = plane_vecs / np.linalg.norm(plane_vecs, axis=1)[:, None]
+    offsets = np.einsum('ijk,ik->ij', corners - np.repeat(centers, sizes, axis=0)[:, None],
+                        np.repeat(plane_vecs, sizes, axis=0))
+    planar = np.maximum.reduceat(np.abs(offsets).max(axis=1), firsts) <= error
+
+    tri_list = tv.tolist()
+    order = order.tolist()
+    ends = np.r_[bounds, num_tris].tolist()
+    for first, end, is_planar in zip(firsts.tolist(), ends, planar.tolist()):
+        group = [tri_list[t] for t in order[first:end]]
+        if len(group) == 1 or not is_planar:
+            polygons += group
+            continue
+
+        ## Walk the patch boundary; patches with holes keep their triangles
+        edges = {(a, b) for t in group for a, b in ((t[0], t[1]), (t[1], t[2]), (t[2], t[0]))}
+        boundary_edges = [(a, b) for (a, b) in edges if (b, a) not in edges]
+        boundary = dict(boundary_edges)
+        start = next(iter(boundary))
+        loop = [start]
+        while boundary.get(loop[-1], start) != start and len(loop) <= len(boundary_edges):
+            loop.append(boundary[loop[-1]])
+        if len(loop) == len(boundary_edges) and boundary.get(loop[-1]) == start:
+            polygons.append(loop)
+        else:
+            polygons += group
+
+    return polygons
+
+def drop_collinear_vertices(vertices, faces, error):
+    faces = [list(ids) for ids in faces]
+    sides = np.asarray([len(ids) for ids in faces])
+    all_ids = np.asarray([id for ids in faces for id in ids], dtype=np.int64)
+    if len(all_ids) == 0:
+        return faces
+    starts = np.cumsum(sides) - sides
+    positions = np.arange(len(all_ids))
+    next_pos = positions + 1
+    next_pos[starts + sides - 1] = starts
+    prev_pos = positions - 1
+    prev_pos[starts] = starts + sides - 1
+
+    ## A corner is straight if it lies within error of the segment joining its neighbors
+    pv = vertices[all_ids[prev_pos]]
+    line = vertices[all_ids[next_pos]] - pv
+    dv = vertices[all_ids] - pv
+    t = np.einsum('ij,ij->i', dv, line) / np.maximum(np.einsum('ij,ij->i', line, line), error**2)
+    straight = (np.linalg.norm(dv - t[:, None] * line, axis=1) < error) & (t > 0) & (t < 1)
+
+    ## Only drop vertices that are straight in every face they belong to, so that the faces
+    ## on either side of the edge they lie on both lose them
+    bent = np.zeros(len(vertices), dtype=bool)
+    bent[all_ids[~straight]] = True
+    faces = [[id for id in ids if bent[id]] for ids in faces]
+    return [ids for ids in faces if len(ids) >= 3]
+
+def iter_point_chunks(source, chunk_size, dtype=np.float64):
+    if isinstance(source, (str, os.PathLike)):
+        if str(source).endswith('.npy'):
+            source = np.load(source, mmap_mode='r')
+        else:
+            source = np.memmap(source, dtype=dtype, mode='r')
+    if isinstance(source, (list, tuple)):
+        source = np.asarray(source, dtype=float)
+
+    if isinstance(source, np.ndarray):
+        pv = source.reshape(-1, 3)
+        for start in range(0, len(pv), chunk_size):
+            yield np.asarray(pv[start:start + chunk_size], dtype=float)
+    else:
+        for chunk in source:
+            yield np.asarray(chunk, dtype=float).reshape(-1, 3)
+
+## The 26 directions of the cube's faces, edges and corners
+extreme_directions = np.asarray([(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1)
+                                 if (x, y, z) != (0, 0, 0)], dtype=float)
+
+def extreme_points(pts):
+    pv = np.asarray(pts, dtype=float).reshape(-1, 3)
+    ids = np.unique(np.argmax(pv @ extreme_directions.T, axis=0))
+    return pv[ids]
+
+def ray_triangle_distances(origins, directions, a, b, c):
+    ov = np.asarray(origins, dtype=float)
+    dv = np.asarray(directions, dtype=float)
+    e1 = b - a
+    e2 = c - a
+
+    ## Moller-Trumbore, broadcasting the rays against the triangles
+    pvec = np.cross(dv, e2)
+    det = np.sum(e1 * pvec, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv_det = 1.0 / det
+        tvec = ov - a
+        u = np.sum(tvec * pvec, axis=-1) * inv_det
+        qvec = np.cross(tvec, e1)
+        v = np.sum(dv * qvec, axis=-1) * inv_det
+        t = np.sum(e2 * qvec, axis=-1) * inv_det
+
+        ## Rays parallel to a triangle leave u, v and t infinite or nan
+        hit = (det != 0) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t >= 0)
+
+    return np.where(hit, t, np.inf)
+
+def closest_points_on_triangles(pts, a, b, c):
+    pv = np.asarray(pts, dtype=float)
+    ab = b - a
+    ac = c - a
+    bc = c - b
+
+    ## Ericson's region tests, broadcasting the points against the triangles
+    ap = pv - a
+    bp = pv - b
+    cp = pv - c
+    d1 = np.sum(ab * ap, axis=-1)
+    d2 = np.sum(ac * ap, axis=-1)
+    d3 = np.sum(ab * bp, axis=-1)
+    d4 = np.sum(ac * bp, axis=-1)
+    d5 = np.sum(ab * cp, axis=-1)
+    d6 = np.sum(ac * cp, axis=-1)
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        on_ab = a + ab * (d1 / (d1 - d3))[..., None]
+        on_ac = a + ac * (d2 / (d2 - d6))[..., None]
+        on_bc = b + bc * ((d4 - d3) / ((d4 - d3) + (d5 - d6)))[..., None]
+        denom = 1.0 / (va + vb + vc)
+        inside = a + ab * (vb * denom)[..., None] + ac * (vc * denom)[..., None]
+
+    shape = inside.shape
+    regions = [
+        (d1 <= 0) & (d2 <= 0),
+        (d3 >= 0) & (d4 <= d3),
+        (vc <= 0) & (d1 >= 0) & (d3 <= 0),
+        (d6 >= 0) & (d5 <= d6),
+        (vb <= 0) & (d2 >= 0) & (d6 <= 0),
+        (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)
+    ]
+    choices = [np.broadcast_to(x, shape) for x in [a, b, on_ab, c, on_ac, on_bc]]
+    return np.select([r[..., None] for r in regions], choices, inside)
+
+def clip_polytope(vertices, face_sizes, face_ids, normal, offset, error):
+    vertices = np.asarray(vertices, dtype=float).reshape(-1, 3)
+    face_sizes = np.asarray(face_sizes, dtype=np.int64)
+    face_ids = np.asarray(face_ids, dtype=np.int64)
+    heights = vertices @ np.asarray(normal, dtype=float) - offset
+    inside = heights <= error
+    if inside.all():
+        return vertices, face_sizes, face_ids
+    if not (heights < -error).any():
+        return None
+
+    ## Faces with no outside vertex pass through whole, those with no inside vertex are dropped,
+    ## and only the faces that the plane actually cuts are walked one by one
+    starts = np.cumsum(face_sizes) - face_sizes
+    num_outside = np.add.reduceat((~inside[face_ids]).astype(np.int64), starts)
+    kept = np.repeat(num_outside == 0, face_sizes)
+    next_pos = np.arange(len(face_ids)) + 1
+    next_pos[starts + face_sizes - 1] = starts
+
+    new_vertices = [vertices]
+    cut_ids = {}
+    num_vertices = len(vertices)
+
+    ## Find (or make) the vertex where the plane cuts the edge from an inside to an outside vertex
+    def cut(a, b):
+        nonlocal num_vertices
+        if heights[a] >= -error: return a
+        key = (min(a, b), max(a, b))
+        if key not in cut_ids:
+            t = heights[a] / (heights[a] - heights[b])
+            new_vertices.append((vertices[a] + t * (vertices[b] - vertices[a]))[None])
+            cut_ids[key] = num_vertices
+            num_vertices += 1
+        return cut_ids[key]
+
+    new_faces = []
+    for face in np.flatnonzero((num_outside > 0) & (num_outside < face_sizes)):
+        ids = face_ids[starts[face]:starts[face] + face_sizes[face]].tolist()
+        clipped = []
+        for a, b in zip(ids, ids[1:] + ids[:1]):
+            if inside[a]:
+                clipped.append(a)
+                if not inside[b]: clipped.append(cut(a, b))
+            elif inside[b]:
+                clipped.append(cut(b, a))
+        clipped = [id for i, id in enumerate(clipped) if id != clipped[i - 1]]
+        if len(clipped) >= 3:
+            new_faces.append(clipped)
+
+    ## The cap closes off the cut, running backward along the edges of the faces on the plane
+    on_plane = np.r_[heights >= -error, np.ones(num_vertices - len(vertices), dtype=bool)]
+    edge_starts = face_ids[kept]
+    edge_ends = face_ids[next_pos][kept]
+    flat = on_plane[edge_starts] & on_plane[edge_ends]
+    cap_edges = dict(zip(edge_ends[flat].tolist(), edge_starts[flat].tolist()))
+    cap_edges.update({b: a for ids in new_faces for a, b in zip(ids, ids[1:] + ids[:1])
+                      if on_plane[a] and on_plane[b]})
+    if len(cap_edges) >= 3:
+        start = next(iter(cap_edges))
+        cap = [start]
+        while cap_edges[cap[-1]] != start and len(cap) < len(cap_edges):
+            cap.append(cap_edges[cap[-1]])
+        new_faces.append(cap)
+
+    new_sizes = np.r_[face_sizes[num_outside == 0], [len(ids) for ids in new_faces]].astype(np.int64)
+    if len(new_sizes) < 4:
+        return None
+
+    ## Renumber the vertices that are still in use
+    new_ids = np.r_[face_ids[kept], [id for ids in new_faces for id in ids]].astype(np.int64)
+    new_vertices = np.concatenate(new_vertices)
+    used = np.zeros(num_vertices, dtype=bool)
+    used[new_ids] = True
+    renumber = np.cumsum(used) - 1
+    return new_vertices[used], new_sizes, renumber[new_ids]